@@ -1,16 +1,23 @@
 import os
-import json
-from typing import List, Optional, AsyncGenerator
-from weakref import ref
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel, Field
+import re
+import asyncio
+import httpx
+import orjson
+from hashlib import blake2b
+from typing import List, Literal, Optional, AsyncGenerator
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from dotenv import load_dotenv
+from cachetools import TTLCache
+from sse_starlette.sse import EventSourceResponse
 
 # Google Gen AI SDK
 import google.genai as genai
 from google.genai import types
+from google.genai import errors as genai_errors
 
 # --- Bootstrap ---
 load_dotenv()  # load .env if present
@@ -21,66 +28,117 @@ if not API_KEY:
 
 DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")  # good default for latency
 
+# Prefer uvloop's event loop when available (falls back to stock asyncio)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # Construct the client once (reuse connection pool)
-client = genai.Client(api_key=API_KEY)
+# Keep-alive HTTP/2 pool sized for concurrent requests to generativelanguage.googleapis.com
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=256, max_connections=512, keepalive_expiry=300)
+client = genai.Client(
+    api_key=API_KEY,
+    http_options=types.HttpOptions(
+        client_args={"limits": _HTTP_LIMITS, "http2": True},
+        async_client_args={"limits": _HTTP_LIMITS, "http2": True},
+    ),
+)
 
 app = FastAPI(
     title="Local Gemini Agent",
     version="1.0.0",
     description="FastAPI microservice that routes requests to Gemini 2.5 via Google Gen AI SDK.",
+    default_response_class=ORJSONResponse,
 )
 
 # --------- Gemini config  ---------
+# Built once; handlers model_copy() this with per-request overrides instead of re-validating
+_DEFAULT_TEMPERATURE = 0.3
+_DEFAULT_MAX_OUTPUT_TOKENS = 1024
+_THINKING_OFF = types.ThinkingConfig(thinking_budget=0)
+_BASE_CFG = types.GenerateContentConfig(
+    temperature = _DEFAULT_TEMPERATURE,
+    max_output_tokens = _DEFAULT_MAX_OUTPUT_TOKENS,
+    response_modalities = ["TEXT"],
+    thinking_config = _THINKING_OFF,
+)
+
+_WARMUP_TIMEOUT = 5.0
+_warmup_task: Optional[asyncio.Task] = None
+
+async def _warmup():
+    """Prime TLS + HTTP/2 to the Gemini endpoint so the first request skips the handshake."""
+    try:
+        # The SDK has no default timeout, so bound it here
+        await asyncio.wait_for(
+            client.aio.models.generate_content(
+                model=DEFAULT_MODEL,
+                contents=[_user_content("ping")],
+                config=_BASE_CFG.model_copy(update={"max_output_tokens": 1}),
+            ),
+            timeout=_WARMUP_TIMEOUT,
+        )
+    except Exception:
+        pass  # warmup is best-effort
+
+@app.on_event("startup")
+async def _start_warmup():
+    # Run in the background so uvicorn starts accepting traffic without waiting on Gemini
+    global _warmup_task
+    _warmup_task = asyncio.create_task(_warmup())
 
 
 
 
 # ----------- Helpers ---------
+_JSON_TAIL_RE = re.compile(r"\{.*\}\Z", re.S)
+
+def _user_content(text: str) -> types.Content:
+    """Typed user turn; saves the SDK a dict -> Content coercion per message."""
+    return types.Content(role="user", parts=[types.Part(text=text)])
 
 def _out_text(resp) -> str:
     """
     Extract plain text from a google-genai GenerateContentResponse (v1.31.0 safe).
-    Avoids .to_dict(); handles both object and dict-like fields.
+    Fast path for typed SDK objects; dict-shaped responses go through _out_text_dict.
     """
-    # 1) Direct convenience attrs (some SDK builds expose these)
-    for attr in ("text", "output_text"):
-        val = getattr(resp, attr, None)
-        if isinstance(val, str) and val.strip():
-            return val
+    if isinstance(resp, dict):
+        return _out_text_dict(resp)
 
-    # 2) Walk candidates -> content -> parts -> text
-    candidates = getattr(resp, "candidates", None)
-    if candidates is None and isinstance(resp, dict):
-        candidates = resp.get("candidates")
-
-    if candidates:
-        texts = []
-        for cand in candidates:
-            content = getattr(cand, "content", None) if not isinstance(cand, dict) else cand.get("content")
-            if not content:
-                continue
-            parts = getattr(content, "parts", None) if not isinstance(content, dict) else content.get("parts")
-            if not parts:
-                continue
-            for p in parts:
-                t = getattr(p, "text", None) if not isinstance(p, dict) else p.get("text")
-                if isinstance(t, str) and t:
-                    texts.append(t)
-        if texts:
-            return "\n".join(texts)
+    # 1) The SDK usually exposes the joined text directly
+    t = getattr(resp, "text", None)
+    if t:
+        return t
 
-    # 3) Nothing found
-    return ""
+    # 2) Walk candidates -> content -> parts -> text
+    out = []
+    for c in getattr(resp, "candidates", None) or ():
+        for p in getattr(getattr(c, "content", None), "parts", None) or ():
+            pt = getattr(p, "text", None)
+            if pt:
+                out.append(pt)
+    return "\n".join(out)
+
+def _out_text_dict(resp: dict) -> str:
+    """Same walk as _out_text for plain dict payloads."""
+    texts = []
+    for cand in resp.get("candidates") or ():
+        for p in (cand.get("content") or {}).get("parts") or ():
+            t = p.get("text")
+            if isinstance(t, str) and t:
+                texts.append(t)
+    return "\n".join(texts)
 
 def _err(detail: str, code: str = "GENERATION_ERROR", status: int = 500):
     """Raise a FastAPI HTTPException in a consistent JSON shape."""
     # Try to surface provider message if present in a JSON tail
     msg = detail
     try:
-        import re
-        m = re.search(r"\{.*\}$", detail, re.S)
+        m = _JSON_TAIL_RE.search(detail) if "{" in detail else None
         if m:
-            j = json.loads(m.group(0))
+            j = orjson.loads(m.group(0))
             provider_msg = j.get("error", {}).get("message")
             if provider_msg:
                 msg = provider_msg
@@ -88,18 +146,36 @@ def _err(detail: str, code: str = "GENERATION_ERROR", status: int = 500):
         pass
     raise HTTPException(status_code=status, detail={"code": code, "message": msg})
 
+def _provider_err(e: genai_errors.APIError):
+    """Raise the provider's own status (e.g. 429) and message; no string scraping needed."""
+    status = e.code if isinstance(e.code, int) and 400 <= e.code < 600 else 500
+    raise HTTPException(status_code=status, detail={"code": "PROVIDER_ERROR", "message": e.message or str(e)})
+
+_DEBUG = bool(os.getenv("GEMINI_DEBUG"))
+_DEBUG_MAX_DEPTH = 3
+
+def _debug_trim(obj, depth: int = 0):
+    """Plain, depth-capped copy of obj so _debug_dump never walks deep SDK object graphs."""
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if depth >= _DEBUG_MAX_DEPTH:
+        return repr(obj)[:200]
+    if isinstance(obj, dict):
+        return {str(k): _debug_trim(v, depth + 1) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, set)):
+        return [_debug_trim(v, depth + 1) for v in obj]
+    # Shallow __dict__ is often enough to see top-level fields (pydantic models included)
+    fields = getattr(obj, "__dict__", None)
+    if isinstance(fields, dict):
+        return _debug_trim(fields, depth + 1)
+    return repr(obj)[:200]
+
 def _debug_dump(obj) -> str:
-    """Best-effort compact representation without .to_dict()."""
-    try:
-        # pydantic models in some builds support model_dump()
-        md = getattr(obj, "model_dump", None)
-        if callable(md):
-            return json.dumps(md(), ensure_ascii=False)[:2000]
-    except Exception:
-        pass
+    """Best-effort compact representation without .to_dict(); "" unless GEMINI_DEBUG is set."""
+    if not _DEBUG:
+        return ""
     try:
-        # Shallow __dict__ is often enough to see top-level fields
-        return json.dumps(getattr(obj, "__dict__", {}), default=str, ensure_ascii=False)[:2000]
+        return orjson.dumps(_debug_trim(obj), default=str).decode()[:2000]
     except Exception:
         pass
     # Fallback to repr
@@ -114,7 +190,7 @@ class PromptRequest(BaseModel):
     temperature: Optional[float] = Field(0.3, ge=0.0, le=2.0)
 
 class ChatMessage(BaseModel):
-    role: str = Field(..., pattern="^(user|model)$")  # Gemini 1.31.0 accepts only user|model
+    role: Literal["user", "model"]  # Gemini 1.31.0 accepts only user|model
     content: str
 
 class ChatRequest(BaseModel):
@@ -123,111 +199,446 @@ class ChatRequest(BaseModel):
     max_output_tokens: Optional[int] = 1024
     temperature: Optional[float] = 0.3
 
-# --------- Routes ---------
-@app.get("/health")
-def health():
-    return JSONResponse(content={"status": "ok", "version": "1.0.0", "service": "gemini-agent"})
+class BatchRequest(BaseModel):
+    prompts: List[str] = Field(..., min_length=1, max_length=100, description="Independent prompts, answered in order.")
+    model: Optional[str] = None
+    system: Optional[str] = Field(None, description="Optional system instruction applied to every prompt.")
+    max_output_tokens: Optional[int] = Field(1024, ge=1, le=8192)
+    temperature: Optional[float] = Field(0.3, ge=0.0, le=2.0)
 
-@app.post("/prompt")
-def prompt(req: PromptRequest):
-    model = req.model or DEFAULT_MODEL
+# Validate raw bodies straight from bytes, skipping FastAPI's per-request body parsing
+_PROMPT_REQ_ADAPTER = TypeAdapter(PromptRequest)
+_CHAT_REQ_ADAPTER = TypeAdapter(ChatRequest)
+_BATCH_REQ_ADAPTER = TypeAdapter(BatchRequest)
+
+def _body_docs(adapter: TypeAdapter) -> dict:
+    """openapi_extra so /docs still shows the JSON body for routes that parse it manually."""
+    schema = adapter.json_schema()
+    defs = schema.pop("$defs", {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            target = node.get("$ref")
+            if target:
+                return inline(defs[target.rsplit("/", 1)[-1]])
+            return {k: inline(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [inline(v) for v in node]
+        return node
+
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": inline(schema)}}}}
+
+async def _parse_body(adapter: TypeAdapter, request: Request):
+    """Validate the JSON body with `adapter`; failures keep FastAPI's usual 422 shape."""
     try:
-        contents = []
-        if req.system:
-            contents.append({"role": "user", "parts": [{"text": f"[System instruction]: {req.system}"}]})
-        contents.append({"role": "user", "parts": [{"text": req.prompt}]})
-
-        cfg = types.GenerateContentConfig(
-            temperature = req.temperature or 0.3,
-            max_output_tokens = req.max_output_tokens or 1024,
-            response_modalities = ["TEXT"],
-            thinking_config = types.ThinkingConfig(thinking_budget=0),
+        return adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
         )
 
-        resp = client.models.generate_content(
-            model=model,
+# --------- Batching ---------
+_BATCH_SYSTEM = (
+    "You will receive several independent requests, each headed '### Request <n>'. "
+    "Answer every one of them separately. For each request emit a line '### Response <n>' "
+    "followed by the answer to that request only, in the same order."
+)
+_BATCH_RESPONSE_RE = re.compile(r"^###\s*Response\s+(\d+)\s*$", re.M)
+
+def _prompt_contents(prompt: str, system: Optional[str] = None) -> list:
+    contents = []
+    if system:
+        contents.append(_user_content(f"[System instruction]: {system}"))
+    contents.append(_user_content(prompt))
+    return contents
+
+def _prompt_cfg(temperature: Optional[float], max_output_tokens: Optional[int]) -> types.GenerateContentConfig:
+    """Per-request config; the one place request defaults are applied for every route."""
+    return _BASE_CFG.model_copy(update={
+        "temperature": temperature if temperature is not None else _DEFAULT_TEMPERATURE,
+        "max_output_tokens": max_output_tokens or _DEFAULT_MAX_OUTPUT_TOKENS,
+    })
+
+class PromptBatcher:
+    """
+    Coalesces /prompt requests that arrive within `max_wait_ms` into one Gemini call.
+    Requests are only merged when model, temperature and max_output_tokens match;
+    a lone request (or any answer missing from the batched reply) goes out as a normal call.
+    Merged prompts share one model context, so only enable this (GEMINI_BATCH_MAX > 1)
+    when every caller is trusted to see and influence the others' requests.
+    """
+
+    def __init__(self, max_batch: int = 8, max_wait_ms: float = 10.0):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+
+    async def submit(self, req: PromptRequest) -> str:
+        if self.max_batch <= 1:
+            return await self.single(req)
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((req, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            # Nothing else waiting: send it straight away instead of holding it for max_wait
+            deadline = loop.time() + self.max_wait if not self._queue.empty() else 0
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for req, fut in items:
+                key = (req.model or DEFAULT_MODEL, req.temperature, req.max_output_tokens)
+                groups.setdefault(key, []).append((req, fut))
+            for group in groups.values():
+                task = asyncio.create_task(self._dispatch(group))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, group: list):
+        if len(group) == 1:
+            req, fut = group[0]
+            try:
+                _resolve(fut, await self.single(req))
+            except Exception as e:
+                _reject(fut, e)
+            return
+
+        try:
+            answers = await self._batched([req for req, _ in group])
+        except Exception as e:
+            for _, fut in group:
+                _reject(fut, e)
+            return
+
+        for i, (req, fut) in enumerate(group):
+            try:
+                out = answers.get(i)
+                _resolve(fut, out if out is not None else await self.single(req))
+            except Exception as e:
+                _reject(fut, e)
+
+    async def single(self, req: PromptRequest) -> str:
+        resp = await client.aio.models.generate_content(
+            model=req.model or DEFAULT_MODEL,
+            contents=_prompt_contents(req.prompt, req.system),
+            config=_prompt_cfg(req.temperature, req.max_output_tokens),
+        )
+        return _out_text(resp)
+
+    async def _batched(self, reqs: List[PromptRequest]) -> dict:
+        contents = []
+        for i, req in enumerate(reqs):
+            text = f"### Request {i}\n{req.prompt}"
+            if req.system:
+                text = f"### Request {i}\n[System instruction]: {req.system}\n{req.prompt}"
+            contents.append(_user_content(text))
+
+        head = reqs[0]
+        cfg = _prompt_cfg(head.temperature, min((head.max_output_tokens or _DEFAULT_MAX_OUTPUT_TOKENS) * len(reqs), 8192))
+        cfg = cfg.model_copy(update={"system_instruction": _BATCH_SYSTEM})
+        resp = await client.aio.models.generate_content(
+            model=head.model or DEFAULT_MODEL,
             contents=contents,
             config=cfg,
         )
-        return {"model": model, "output": _out_text(resp)}
+
+        # Split "### Response <n>" blocks back out per request
+        text = _out_text(resp)
+        marks = list(_BATCH_RESPONSE_RE.finditer(text))
+        answers = {}
+        for j, m in enumerate(marks):
+            end = marks[j + 1].start() if j + 1 < len(marks) else len(text)
+            idx = int(m.group(1))
+            if 0 <= idx < len(reqs):
+                answers[idx] = text[m.end():end].strip()
+        return answers
+
+def _resolve(fut: asyncio.Future, value):
+    if not fut.done():
+        fut.set_result(value)
+
+def _reject(fut: asyncio.Future, exc: BaseException):
+    if not fut.done():
+        fut.set_exception(exc)
+
+batcher = PromptBatcher(
+    max_batch=int(os.getenv("GEMINI_BATCH_MAX", "1")),
+    max_wait_ms=float(os.getenv("GEMINI_BATCH_WAIT_MS", "10")),
+)
+
+# --------- Response cache ---------
+# Only deterministic (temperature == 0) replies are cached; identical in-flight requests share one call
+_RESP_CACHE = TTLCache(
+    maxsize=int(os.getenv("GEMINI_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("GEMINI_CACHE_TTL", "600")),
+)
+_CACHE_LOCKS: dict = {}
+
+def _cache_key(temperature: Optional[float], *parts) -> Optional[bytes]:
+    if temperature != 0:
+        return None
+    return blake2b(orjson.dumps(parts), digest_size=16).digest()
+
+async def _cached(key: Optional[bytes], compute) -> str:
+    if key is None:
+        return await compute()
+    out = _RESP_CACHE.get(key)
+    if out is not None:
+        return out
+
+    # Single-flight: the first caller computes, concurrent duplicates wait and then hit the cache
+    # The entry is refcounted so it is only dropped once no caller holds or waits on the lock
+    entry = _CACHE_LOCKS.get(key)
+    if entry is None:
+        entry = _CACHE_LOCKS[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            out = _RESP_CACHE.get(key)
+            if out is None:
+                out = await compute()
+                if out:
+                    _RESP_CACHE[key] = out
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _CACHE_LOCKS.pop(key, None)
+    return out
+
+# --------- Routes ---------
+# Static payloads, serialized once (probed every few seconds by k8s)
+_HEALTH_BYTES = orjson.dumps({"status": "ok", "version": "1.0.0", "service": "gemini-agent"})
+_VERSIONS_BYTES = orjson.dumps({
+    "service": "gemini-agent",
+    "sdk_version": getattr(genai, "__version__", "unknown"),
+    "model_default": DEFAULT_MODEL,
+    "has_models_api": hasattr(client, "models"),
+    "env_key_present": bool(API_KEY),
+})
+
+@app.get("/health")
+async def health():
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
+
+@app.post("/prompt", openapi_extra=_body_docs(_PROMPT_REQ_ADAPTER))
+async def prompt(request: Request):
+    req = await _parse_body(_PROMPT_REQ_ADAPTER, request)
+    model = req.model or DEFAULT_MODEL
+    key = _cache_key(req.temperature, model, req.max_output_tokens, req.system, req.prompt)
+    try:
+        # Cacheable replies never go through the batcher: a merged call can be shaped by other callers
+        if key is not None:
+            return {"model": model, "output": await _cached(key, lambda: batcher.single(req))}
+        return {"model": model, "output": await batcher.submit(req)}
+    except genai_errors.APIError as e:
+        _provider_err(e)
     except Exception as e:
         _err(str(e))
 
-@app.post("/chat")
-def chat(req: ChatRequest):
+@app.post("/chat", openapi_extra=_body_docs(_CHAT_REQ_ADAPTER))
+async def chat(request: Request):
+    req = await _parse_body(_CHAT_REQ_ADAPTER, request)
     model = req.model or DEFAULT_MODEL
-    contents = [{"role": m.role, "parts": [{"text": m.content}]} for m in req.messages]
+    contents = [types.Content(role=m.role, parts=[types.Part(text=m.content)]) for m in req.messages]
+    key = _cache_key(
+        req.temperature, model, req.max_output_tokens,
+        [(m.role, m.content) for m in req.messages],
+    )
+
+    async def generate() -> str:
+        cfg = _prompt_cfg(req.temperature, req.max_output_tokens)
+        resp = await client.aio.models.generate_content(model=model, contents=contents, config=cfg)
+        return _out_text(resp)
+
     try:
-        cfg = types.GenerateContentConfig(
-            temperature = req.temperature or 0.3,
-            max_output_tokens = req.max_output_tokens or 1024,
-            response_modalities = ["TEXT"],
-            thinking_config = types.ThinkingConfig(thinking_budget=0),
-        )
-        resp = client.models.generate_content(model=model, contents=contents, config=cfg)
-        return {"model": model, "output": _out_text(resp)}
+        return {"model": model, "output": await _cached(key, generate)}
+    except genai_errors.APIError as e:
+        _provider_err(e)
     except Exception as e:
         _err(str(e))
 
+# --- Concurrent multi-prompt fan-out ---
+_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "8")))
+
+async def _one(contents: list, cfg: types.GenerateContentConfig, model: str) -> str:
+    async with _SEM:
+        resp = await client.aio.models.generate_content(model=model, contents=contents, config=cfg)
+        return _out_text(resp)
+
+@app.post("/batch", openapi_extra=_body_docs(_BATCH_REQ_ADAPTER))
+async def batch(request: Request):
+    req = await _parse_body(_BATCH_REQ_ADAPTER, request)
+    model = req.model or DEFAULT_MODEL
+    cfg = _prompt_cfg(req.temperature, req.max_output_tokens)
+    outs = await asyncio.gather(
+        *[_one(_prompt_contents(p, req.system), cfg, model) for p in req.prompts],
+        return_exceptions=True,
+    )
+    return {
+        "model": model,
+        "outputs": [
+            o if isinstance(o, str)
+            else {"error": (o.message if isinstance(o, genai_errors.APIError) else None) or str(o)}
+            for o in outs
+        ],
+    }
+
 # --- Streaming via Server-Sent Events (SSE) ---
-@app.post("/stream")
-def stream(req: PromptRequest):
+_SSE_FLUSH_CHARS = 512
+_SSE_FLUSH_SECS = 0.015
+
+# Pre-framed SSE bytes (same \r\n separator sse-starlette uses); EventSourceResponse passes
+# bytes through untouched, so hot-loop events skip ServerSentEvent building and re-encoding
+_SSE_DELTA = b"event: delta\r\ndata: "
+_SSE_FINAL = b"event: final\r\ndata: "
+_SSE_ERR = b"event: error\r\ndata: "
+_SSE_POST = b"\r\n\r\n"
+_SSE_DONE = b"event: done\r\ndata: {}" + _SSE_POST
+
+# Per-stream buffer between the Gemini reader and the client writer
+_STREAM_QUEUE_SIZE = 32
+_STREAM_END = object()
+
+async def _coalesce(stream_iter) -> AsyncGenerator[str, None]:
+    """
+    Merge text deltas that arrive within _SSE_FLUSH_SECS (or until _SSE_FLUSH_CHARS)
+    into one block, so a verbose reply costs a handful of SSE frames instead of one per token.
+    """
+    loop = asyncio.get_running_loop()
+    it = stream_iter.__aiter__()
+    buf, size = [], 0
+    last_flush = loop.time()
+    nxt = None
+    try:
+        while True:
+            # Keep one pending read; an idle gap only flushes, it never cancels the read
+            if nxt is None:
+                nxt = asyncio.ensure_future(it.__anext__())
+            timeout = max(0.0, _SSE_FLUSH_SECS - (loop.time() - last_flush)) if buf else None
+            done, _ = await asyncio.wait((nxt,), timeout=timeout)
+            if not done:
+                yield "".join(buf)
+                buf, size = [], 0
+                last_flush = loop.time()
+                continue
+
+            task, nxt = nxt, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # Deliver what Gemini already sent before surfacing the error
+                if buf:
+                    yield "".join(buf)
+                raise
+            delta = getattr(chunk, "text", None)
+            if delta:
+                buf.append(delta)
+                size += len(delta)
+            if buf and (size >= _SSE_FLUSH_CHARS or loop.time() - last_flush >= _SSE_FLUSH_SECS):
+                yield "".join(buf)
+                buf, size = [], 0
+                last_flush = loop.time()
+
+        if buf:
+            yield "".join(buf)
+    finally:
+        if nxt is not None:
+            nxt.cancel()
+
+async def _produce(stream_iter, q: asyncio.Queue):
+    """Read coalesced deltas from Gemini into q; a slow client only ever pauses its own producer."""
+    try:
+        async for delta in _coalesce(stream_iter):
+            await q.put(delta)
+    except Exception as e:
+        await q.put(e)
+    else:
+        await q.put(_STREAM_END)
+
+async def _drain(q: asyncio.Queue) -> AsyncGenerator[str, None]:
+    """Yield deltas from q until the producer finishes; re-raise anything it failed with."""
+    while True:
+        item = await q.get()
+        if item is _STREAM_END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+@app.post("/stream", openapi_extra=_body_docs(_PROMPT_REQ_ADAPTER))
+async def stream(request: Request, echo_final: bool = False):
+    req = await _parse_body(_PROMPT_REQ_ADAPTER, request)
+
     async def event_gen():
         model = req.model or DEFAULT_MODEL
         try:
-            contents = []
-            if req.system:
-                contents.append({"role": "user", "parts": [{"text": f"[System instruction]: {req.system}"}]})
-            contents.append({"role": "user", "parts": [{"text": req.prompt}]})
+            contents = _prompt_contents(req.prompt, req.system)
 
-            # No context manager — iterate the generator directly
-            final = []
-            stream_iter = client.models.generate_content_stream(
+            # Native async stream — chunks are awaited without blocking the event loop
+            # Full text is only kept when the caller opts in with ?echo_final=1
+            final = [] if echo_final else None
+            stream_iter = await client.aio.models.generate_content_stream(
                 model=model,
                 contents=contents,
-                config=genai.types.GenerateContentConfig(
-                    temperature=req.temperature or 0.3,
-                    max_output_tokens=req.max_output_tokens or 1024,
-                    response_modalities=["TEXT"],
-                    thinking_config=genai.types.ThinkingConfig(thinking_budget=0),
-                ),
+                config=_prompt_cfg(req.temperature, req.max_output_tokens),
             )
 
-            for chunk in stream_iter:
-                delta = getattr(chunk, "text", None)
-                if delta:
-                    final.append(delta)
-                    yield f"data: {json.dumps({'delta': delta})}\n\n".encode("utf-8")
+            # Decouple the Gemini reader from the client socket; cancelled if the client goes away
+            q = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+            producer = asyncio.create_task(_produce(stream_iter, q))
+            try:
+                async for delta in _drain(q):
+                    if final is not None:
+                        final.append(delta)
+                    yield b"".join((_SSE_DELTA, orjson.dumps({"delta": delta}), _SSE_POST))
+            finally:
+                producer.cancel()
 
             # done
-            yield f"data: {json.dumps({'final': ''.join(final)})}\n\n".encode("utf-8")
+            if final is not None:
+                yield b"".join((_SSE_FINAL, orjson.dumps({"final": "".join(final)}), _SSE_POST))
+            yield _SSE_DONE
 
+        except genai_errors.APIError as e:
+            yield b"".join((_SSE_ERR, orjson.dumps({"error": e.message or str(e), "status": e.code}), _SSE_POST))
         except Exception as e:
             # surface streaming errors to the client
-            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n".encode("utf-8")
-
-    return StreamingResponse(
-        event_gen(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+            yield b"".join((_SSE_ERR, orjson.dumps({"error": str(e)}), _SSE_POST))
 
-@app.get("/versions")
-def versions():
-    import google.genai as _genai
-    return {
-        "service": "gemini-agent",
-        "sdk_version": getattr(_genai, "__version__", "unknown"),
-        "model_default": DEFAULT_MODEL,
-        "has_models_api": hasattr(client, "models"),
-        "env_key_present": bool(API_KEY),
-    }
+    # sse-starlette sets the no-cache / no-buffering headers and sends a keepalive ping every 15s
+    return EventSourceResponse(event_gen(), ping=15)
 
-# Optional local run helper:
-# if __name__ == "__main__":
-#     import uvicorn
-#     uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
\ No newline at end of file
+@app.get("/versions")
+async def versions():
+    return Response(content=_VERSIONS_BYTES, media_type="application/json")
+
+# Local/prod run helper: uvloop + httptools instead of uvicorn's asyncio/h11 defaults
+# (WEB_CONCURRENCY sets the worker count, same as the uvicorn CLI)
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        log_level="warning",
+    )